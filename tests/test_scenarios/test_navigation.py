@@ -9,7 +9,7 @@ from vmas.scenarios.navigation import HeuristicPolicy
 
 
 class TestNavigation:
-    def setUp(self, n_envs, n_agents) -> None:
+    def setUp(self, n_envs, n_agents, **kwargs) -> None:
         self.continuous_actions = True
 
         self.env = make_env(
@@ -19,9 +19,140 @@ class TestNavigation:
             continuous_actions=self.continuous_actions,
             # Environment specific variables
             n_agents=n_agents,
+            **kwargs,
         )
         self.env.seed(0)
 
+    @pytest.mark.parametrize("collisions", [True, False])
+    def test_agent_collision_rew(self, collisions, n_envs=3, n_agents=3):
+        self.setUp(n_envs=n_envs, n_agents=n_agents, collisions=collisions)
+        self.env.reset()
+
+        # Positions of each agent in the 3 envs. Agents 0 and 1 overlap in env 0,
+        # are within the collision margin in env 1 and are apart in env 2. Agent 2 is always apart.
+        agents_pos = [
+            [[0.0, 0.0], [0.0, 0.0], [0.0, 0.0]],
+            [[0.1, 0.0], [0.203, 0.0], [0.5, 0.0]],
+            [[-0.6, 0.0], [-0.6, 0.0], [-0.6, 0.0]],
+        ]
+        for agent, pos in zip(self.env.agents, agents_pos):
+            agent.set_pos(torch.tensor(pos), batch_index=None)
+        self.env.get_from_scenario(
+            get_observations=False,
+            get_rewards=True,
+            get_infos=False,
+            get_dones=False,
+        )
+
+        penalty = self.env.scenario.agent_collision_penalty
+        expected_collision_rew = (
+            [[penalty, penalty, 0], [penalty, penalty, 0], [0, 0, 0]]
+            if collisions
+            else [[0, 0, 0]] * n_agents
+        )
+        for agent, expected in zip(self.env.agents, expected_collision_rew):
+            assert torch.allclose(
+                agent.agent_collision_rew, torch.tensor(expected, dtype=torch.float)
+            )
+
+    def test_set_pos_without_step(self, n_envs=3, n_agents=3):
+        self.setUp(n_envs=n_envs, n_agents=n_agents)
+        self.env.reset()
+
+        # Moving all agents onto their goals is seen without stepping the environment
+        for agent in self.env.agents:
+            agent.set_pos(agent.goal.state.pos, batch_index=None)
+        obs, _, dones, _ = self.env.get_from_scenario(
+            get_observations=True,
+            get_rewards=True,
+            get_infos=True,
+            get_dones=True,
+        )
+
+        assert dones.all()
+        for agent, agent_obs in zip(self.env.agents, obs):
+            assert torch.allclose(agent_obs[:, :2], agent.goal.state.pos)
+            assert (agent.distance_to_goal == 0).all()
+
+    @pytest.mark.parametrize("observe_all_goals", [True, False])
+    @pytest.mark.parametrize("collisions", [True, False])
+    def test_torch_compile(
+        self, observe_all_goals, collisions, n_envs=4, n_agents=3, n_steps=5
+    ):
+        envs = [
+            make_env(
+                scenario="navigation",
+                num_envs=n_envs,
+                device="cpu",
+                seed=0,
+                continuous_actions=True,
+                n_agents=n_agents,
+                observe_all_goals=observe_all_goals,
+                collisions=collisions,
+                torch_compile=torch_compile,
+            )
+            for torch_compile in (False, True)
+        ]
+        # Both envs draw their spawn positions from the global generator
+        for env in envs:
+            env.seed(0)
+            env.reset()
+
+        generator = torch.Generator().manual_seed(0)
+        for _ in range(n_steps):
+            actions = [
+                torch.rand(n_envs, 2, generator=generator) * 2 - 1
+                for _ in range(n_agents)
+            ]
+            eager_step, compiled_step = (env.step(actions) for env in envs)
+            # Observations, rewards and dones
+            for eager, compiled in zip(eager_step[:3], compiled_step[:3]):
+                torch.testing.assert_close(compiled, eager)
+
+    @pytest.mark.parametrize("shared_rew", [True, False])
+    def test_gather_rewards(self, shared_rew, n_envs=4, n_agents=3):
+        self.setUp(n_envs=n_envs, n_agents=n_agents, shared_rew=shared_rew)
+        self.env.reset()
+
+        _, rews, _, _ = self.env.step(self.env.get_random_actions())
+
+        torch.testing.assert_close(
+            self.env.scenario.gather_rewards(), torch.stack(rews, dim=-1)
+        )
+
+    @pytest.mark.parametrize("obs_dtype", [torch.float16, torch.float64])
+    def test_obs_dtype(self, obs_dtype, n_envs=4, n_agents=2):
+        self.setUp(n_envs=n_envs, n_agents=n_agents, obs_dtype=obs_dtype)
+
+        obs = self.env.reset()
+        for agent_obs, obs_space in zip(obs, self.env.observation_space.spaces):
+            assert agent_obs.dtype == obs_dtype
+            assert obs_space.dtype == agent_obs[0].numpy().dtype
+            assert obs_space.contains(agent_obs[0].numpy())
+
+    def test_obs_dtype_unsupported(self, n_envs=4, n_agents=2):
+        with pytest.raises(ValueError):
+            self.setUp(n_envs=n_envs, n_agents=n_agents, obs_dtype=torch.bfloat16)
+
+    @pytest.mark.parametrize("env_index", [None, 3])
+    def test_goals_spawn_distance(self, env_index, n_envs=10, n_agents=5):
+        self.setUp(n_envs=n_envs, n_agents=n_agents)
+        min_dist = self.env.scenario.min_distance_between_entities
+
+        if env_index is None:
+            self.env.reset()
+        else:
+            self.env.reset_at(env_index)
+
+        entities = self.env.world.agents + self.env.world.landmarks
+        entities_pos = torch.stack([e.state.pos for e in entities], dim=1)
+        if env_index is not None:
+            entities_pos = entities_pos[env_index].unsqueeze(0)
+        dist = torch.cdist(entities_pos, entities_pos)
+        # Ignore the distance of each entity from itself
+        dist += torch.eye(len(entities)) * min_dist
+        assert (dist >= min_dist - 1e-6).all()
+
     @pytest.mark.parametrize("n_agents", [1])
     def test_heuristic(
         self,
@@ -55,3 +186,59 @@ class TestNavigation:
                 for env_index, done in enumerate(dones):
                     if done:
                         self.env.reset_at(env_index)
+
+    @staticmethod
+    def clf_qp_objective(u, clf_value, LgV_vals, clf_slack):
+        clf_slack_value = torch.clamp(clf_value + (LgV_vals * u).sum(-1), min=0)
+        return (u**2).sum(-1) + clf_slack * clf_slack_value**2
+
+    @pytest.mark.parametrize("u_range", [0.5, 1.0])
+    def test_heuristic_qp_grid_search(
+        self, u_range, n_envs=16, n_points=401, clf_slack=100.0
+    ):
+        generator = torch.Generator().manual_seed(0)
+        clf_value = torch.randn(n_envs, generator=generator, dtype=torch.float64) * 3
+        LgV_vals = torch.randn(n_envs, 2, generator=generator, dtype=torch.float64) * 2
+
+        policy = HeuristicPolicy(continuous_action=True, clf_slack=clf_slack)
+        action = policy.solve_clf_qp(clf_value, LgV_vals, u_range)
+        assert (action.abs() <= u_range).all()
+
+        axis = torch.linspace(-u_range, u_range, n_points, dtype=torch.float64)
+        grid = torch.cartesian_prod(axis, axis)
+        grid_objective = self.clf_qp_objective(
+            grid, clf_value.unsqueeze(-1), LgV_vals.unsqueeze(1), clf_slack
+        )
+        action_objective = self.clf_qp_objective(action, clf_value, LgV_vals, clf_slack)
+        # The closed-form optimum must be at least as good as every grid point
+        assert (action_objective <= grid_objective.min(-1)[0] + 1e-9).all()
+
+    @pytest.mark.parametrize(
+        "clf_value,LgV_vals,expected_action",
+        [
+            # CLF constraint already satisfied
+            (-1.0, [3.0, -2.0], [0.0, 0.0]),
+            (0.0, [3.0, -2.0], [0.0, 0.0]),
+            # One saturated component
+            (5.0, [4.0, 1.0], [-1.0, -1.0 / 1.01]),
+            # Both components saturated
+            (100.0, [2.0, 2.0], [-1.0, -1.0]),
+        ],
+    )
+    def test_heuristic_qp_saturation(self, clf_value, LgV_vals, expected_action):
+        policy = HeuristicPolicy(continuous_action=True, clf_slack=100.0)
+        action = policy.solve_clf_qp(
+            torch.tensor([clf_value], dtype=torch.float64),
+            torch.tensor([LgV_vals], dtype=torch.float64),
+            1.0,
+        )
+        torch.testing.assert_close(
+            action, torch.tensor([expected_action], dtype=torch.float64)
+        )
+
+    def test_heuristic_qp_zero_slack(self, n_envs=4):
+        policy = HeuristicPolicy(continuous_action=True, clf_slack=0.0)
+        action = policy.solve_clf_qp(
+            torch.full((n_envs,), 5.0), torch.ones(n_envs, 2), 1.0
+        )
+        torch.testing.assert_close(action, torch.zeros(n_envs, 2))
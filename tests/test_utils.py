@@ -0,0 +1,99 @@
+#  Copyright (c) 2024.
+#  ProrokLab (https://www.proroklab.org/)
+#  All rights reserved.
+
+import pytest
+import torch
+
+from vmas.simulator.utils import CudaGraphFunction, TorchUtils
+
+
+def test_all_gather_without_process_group(n_envs=4):
+    assert not (torch.distributed.is_available() and torch.distributed.is_initialized())
+    tensor = torch.rand(n_envs, 3)
+
+    gathered = TorchUtils.all_gather(tensor)
+
+    assert gathered is tensor
+
+
+@pytest.mark.skipif(
+    not (torch.distributed.is_available() and torch.distributed.is_gloo_available()),
+    reason="Requires the gloo backend",
+)
+def test_all_gather_single_rank(n_envs=4):
+    torch.distributed.init_process_group(
+        "gloo", store=torch.distributed.HashStore(), rank=0, world_size=1
+    )
+    try:
+        tensor = torch.rand(n_envs, 3)
+
+        gathered = TorchUtils.all_gather(tensor)
+
+        assert gathered is not tensor
+        torch.testing.assert_close(gathered, tensor)
+    finally:
+        torch.distributed.destroy_process_group()
+
+
+def _all_gather_worker(rank, init_file, batch_sizes, n_features):
+    torch.distributed.init_process_group(
+        "gloo",
+        init_method=f"file://{init_file}",
+        rank=rank,
+        world_size=len(batch_sizes),
+    )
+    try:
+        tensor = torch.full((batch_sizes[rank], n_features), float(rank))
+        if len(set(batch_sizes)) > 1:
+            with pytest.raises(ValueError):
+                TorchUtils.all_gather(tensor)
+        else:
+            expected = torch.cat(
+                [
+                    torch.full((batch_size, n_features), float(other_rank))
+                    for other_rank, batch_size in enumerate(batch_sizes)
+                ]
+            )
+            torch.testing.assert_close(TorchUtils.all_gather(tensor), expected)
+    finally:
+        torch.distributed.destroy_process_group()
+
+
+@pytest.mark.skipif(
+    not (torch.distributed.is_available() and torch.distributed.is_gloo_available()),
+    reason="Requires the gloo backend",
+)
+@pytest.mark.parametrize("batch_sizes", [[4, 4], [4, 3]])
+def test_all_gather_two_ranks(tmp_path, batch_sizes, n_features=3):
+    # Each rank checks its own result, so failures in the workers fail the spawn
+    torch.multiprocessing.spawn(
+        _all_gather_worker,
+        args=(tmp_path / "init", batch_sizes, n_features),
+        nprocs=len(batch_sizes),
+    )
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="CUDA graphs require CUDA")
+def test_cuda_graph_function(warmup_calls=2, n_calls=6):
+    def fn(x, y, scale):
+        return x * scale + y.sum(), torch.cdist(x, y)
+
+    cuda_graph_fn = CudaGraphFunction(fn, warmup_calls=warmup_calls)
+    # Covers the eager warmup calls, the recording call and the replays
+    for _ in range(n_calls):
+        x = torch.rand(4, 2, device="cuda")
+        y = torch.rand(5, 2, device="cuda")
+
+        outputs = cuda_graph_fn(x, y, 2.0)
+        expected_outputs = fn(x, y, 2.0)
+
+        for output, expected_output in zip(outputs, expected_outputs):
+            torch.testing.assert_close(output, expected_output)
+
+
+def test_cuda_graph_function_requires_grad():
+    cuda_graph_fn = CudaGraphFunction(lambda x: x * 2)
+
+    with pytest.raises(RuntimeError):
+        cuda_graph_fn(torch.rand(4, 2, requires_grad=True))
@@ -2,7 +2,7 @@
 #  ProrokLab (https://www.proroklab.org/)
 #  All rights reserved.
 import typing
-from typing import Callable, Dict, List
+from typing import Callable, Dict, List, Optional, Tuple
 
 import torch
 from torch import Tensor
@@ -12,7 +12,14 @@ from vmas.simulator.core import Agent, Entity, Landmark, Sphere, World
 from vmas.simulator.heuristic_policy import BaseHeuristicPolicy
 from vmas.simulator.scenario import BaseScenario
 from vmas.simulator.sensors import Lidar
-from vmas.simulator.utils import Color, ScenarioUtils, X, Y
+from vmas.simulator.utils import (
+    Color,
+    CudaGraphFunction,
+    ScenarioUtils,
+    TorchUtils,
+    X,
+    Y,
+)
 
 if typing.TYPE_CHECKING:
     from vmas.simulator.rendering import Geom
@@ -48,8 +55,24 @@ class Scenario(BaseScenario):
         self.final_reward = kwargs.pop("final_reward", 0.01)
 
         self.agent_collision_penalty = kwargs.pop("agent_collision_penalty", -1)
+        self.obs_dtype = kwargs.pop(
+            "obs_dtype", None
+        )  # If set (e.g., torch.float16), observations are cast to this dtype for policy consumption
+        self.torch_compile = kwargs.pop(
+            "torch_compile", False
+        )  # If True, the batched reward and observation computations are compiled with torch.compile
+        self.cuda_graphs = kwargs.pop(
+            "cuda_graphs", False
+        )  # If True, the batched reward and observation computations are replayed from CUDA graphs (no autograd)
         ScenarioUtils.check_kwargs_consumed(kwargs)
 
+        # Observation spaces and the gym wrappers are numpy based, so dtypes numpy cannot
+        # represent (e.g., torch.bfloat16) are not supported
+        if self.obs_dtype not in (None, torch.float16, torch.float32, torch.float64):
+            raise ValueError(
+                f"obs_dtype must be one of torch.float16, torch.float32 or torch.float64, got {self.obs_dtype}"
+            )
+
         self.min_distance_between_entities = self.agent_radius * 2 + 0.05
         self.min_collision_distance = 0.005
 
@@ -92,10 +115,11 @@ class Scenario(BaseScenario):
             (0.89, 0.10, 0.11),
             (0.87, 0.87, 0),
         ]
-        colors = torch.randn(
-            (max(self.n_agents - len(known_colors), 0), 3), device=device
-        )
-        entity_filter_agents: Callable[[Entity], bool] = lambda e: isinstance(e, Agent)
+        # Colors are only read by the renderer, so they are kept on cpu as python lists
+        colors = torch.randn((max(self.n_agents - len(known_colors), 0), 3)).tolist()
+        # Set membership is cheaper than an isinstance check in the lidar ray casting
+        agents = set()
+        entity_filter_agents: Callable[[Entity], bool] = agents.__contains__
 
         # Add agents
         for i in range(self.n_agents):
@@ -125,9 +149,11 @@ class Scenario(BaseScenario):
                     else None
                 ),
             )
+            agent.agent_index = i
             agent.pos_rew = torch.zeros(batch_dim, device=device)
             agent.agent_collision_rew = agent.pos_rew.clone()
             world.add_agent(agent)
+            agents.add(agent)
 
             # Add goals
             goal = Landmark(
@@ -138,8 +164,52 @@ class Scenario(BaseScenario):
             world.add_landmark(goal)
             agent.goal = goal
 
+        # All goals share the same shape
+        self.goal_radius = world.landmarks[0].shape.radius
+
         self.pos_rew = torch.zeros(batch_dim, device=device)
         self.final_rew = self.pos_rew.clone()
+        self.final_rew_reached = torch.tensor(
+            self.final_reward, dtype=torch.float32, device=device
+        )
+        self.final_rew_not_reached = torch.zeros((), device=device)
+        self.distance_to_goal = torch.zeros(batch_dim, self.n_agents, device=device)
+        self.pos_shaping = self.distance_to_goal.clone()
+        # Buffers for the stacked positions, refilled in place every step
+        self.agents_pos_buffer = torch.zeros(
+            batch_dim, self.n_agents, world.dim_p, device=device
+        )
+        self.goals_pos = self.agents_pos_buffer.clone()
+
+        # Collision flags and filters are static, so the agent pairs that can collide are computed once
+        self.agents_collide_mask = torch.tensor(
+            [
+                [a is not b and a.collides(b) and b.collides(a) for b in world.agents]
+                for a in world.agents
+            ],
+            dtype=torch.bool,
+            device=device,
+        )
+        self.agents_can_collide = bool(self.agents_collide_mask.any())
+
+        self.agents_reward_fn = self.compute_agents_reward
+        self.agents_collisions_fn = self.compute_agents_collisions
+        self.agents_obs_fn = self.compute_agents_obs
+        if self.torch_compile:
+            self.agents_reward_fn = torch.compile(self.agents_reward_fn, dynamic=False)
+            self.agents_collisions_fn = torch.compile(
+                self.agents_collisions_fn, dynamic=False
+            )
+            self.agents_obs_fn = torch.compile(
+                self.agents_obs_fn, fullgraph=True, dynamic=False
+            )
+        if self.cuda_graphs:
+            assert (
+                torch.device(device).type == "cuda"
+            ), "CUDA graphs are only available on cuda devices"
+            self.agents_reward_fn = CudaGraphFunction(self.agents_reward_fn)
+            self.agents_collisions_fn = CudaGraphFunction(self.agents_collisions_fn)
+            self.agents_obs_fn = CudaGraphFunction(self.agents_obs_fn)
 
         return world
 
@@ -161,7 +231,7 @@ class Scenario(BaseScenario):
 
         goal_poses = []
         for _ in self.world.agents:
-            position = ScenarioUtils.find_random_pos_for_entity(
+            position = ScenarioUtils.find_random_pos_for_entity_with_candidates(
                 occupied_positions=occupied_positions,
                 env_index=env_index,
                 world=self.world,
@@ -180,102 +250,156 @@ class Scenario(BaseScenario):
 
             agent.goal.set_pos(goal_poses[goal_index], batch_index=env_index)
 
-            if env_index is None:
-                agent.pos_shaping = (
-                    torch.linalg.vector_norm(
-                        agent.state.pos - agent.goal.state.pos,
-                        dim=1,
-                    )
-                    * self.pos_shaping_factor
-                )
-            else:
-                agent.pos_shaping[env_index] = (
-                    torch.linalg.vector_norm(
-                        agent.state.pos[env_index] - agent.goal.state.pos[env_index]
-                    )
-                    * self.pos_shaping_factor
-                )
+        # Goals do not move during an episode, so their positions are stacked once per reset
+        torch.stack(
+            [a.goal.state.pos for a in self.world.agents], dim=1, out=self.goals_pos
+        )
+
+        self.update_agents_pos()
+
+        if env_index is None:
+            self.distance_to_goal = torch.linalg.vector_norm(
+                self.agents_pos - self.goals_pos,
+                dim=-1,
+            )
+            self.pos_shaping = self.distance_to_goal * self.pos_shaping_factor
+        else:
+            self.distance_to_goal[env_index] = torch.linalg.vector_norm(
+                self.agents_pos[env_index] - self.goals_pos[env_index],
+                dim=-1,
+            )
+            self.pos_shaping[env_index] = (
+                self.distance_to_goal[env_index] * self.pos_shaping_factor
+            )
 
     def reward(self, agent: Agent):
         is_first = agent == self.world.agents[0]
 
         if is_first:
-            self.pos_rew[:] = 0
-            self.final_rew[:] = 0
-
-            for a in self.world.agents:
-                self.pos_rew += self.agent_reward(a)
-                a.agent_collision_rew[:] = 0
-
-            self.all_goal_reached = torch.all(
-                torch.stack([a.on_goal for a in self.world.agents], dim=-1),
-                dim=-1,
+            # Positions are restacked so that they reflect any external set_pos
+            self.update_agents_pos()
+            self.pos_rew = self.agents_reward(self.agents_pos).sum(-1)
+
+            self.all_goal_reached = self.on_goal.all(-1)
+            self.final_rew = torch.where(
+                self.all_goal_reached,
+                self.final_rew_reached,
+                self.final_rew_not_reached,
             )
 
-            self.final_rew[self.all_goal_reached] = self.final_reward
-
-            for i, a in enumerate(self.world.agents):
-                for j, b in enumerate(self.world.agents):
-                    if i <= j:
-                        continue
-                    if self.world.collides(a, b):
-                        distance = self.world.get_distance(a, b)
-                        a.agent_collision_rew[
-                            distance <= self.min_collision_distance
-                        ] += self.agent_collision_penalty
-                        b.agent_collision_rew[
-                            distance <= self.min_collision_distance
-                        ] += self.agent_collision_penalty
+            if self.agents_can_collide:
+                agents_collision_rew = (
+                    self.agents_collisions_fn(
+                        torch.cdist(self.agents_pos, self.agents_pos)
+                    ).to(self.pos_rew.dtype)
+                    * self.agent_collision_penalty
+                )
+                for i, a in enumerate(self.world.agents):
+                    a.agent_collision_rew = agents_collision_rew[:, i]
+
+        return self.agent_total_reward(agent)
 
+    def agent_total_reward(self, agent: Agent) -> Tensor:
+        # Last reward of the agent, computed by reward() when called for the first agent
         pos_reward = self.pos_rew if self.shared_rew else agent.pos_rew
         return pos_reward + self.final_rew + agent.agent_collision_rew
 
-    def agent_reward(self, agent: Agent):
-        agent.distance_to_goal = torch.linalg.vector_norm(
-            agent.state.pos - agent.goal.state.pos,
-            dim=-1,
-        )
-        agent.on_goal = agent.distance_to_goal < agent.goal.shape.radius
-
-        pos_shaping = agent.distance_to_goal * self.pos_shaping_factor
-        agent.pos_rew = agent.pos_shaping - pos_shaping
-        agent.pos_shaping = pos_shaping
-        return agent.pos_rew
+    def update_agents_pos(self):
+        # Stacked by the first agent's reward and observation and shared by the others
+        agents_pos = [a.state.pos for a in self.world.agents]
+        if any(pos.requires_grad for pos in agents_pos):
+            # Out arguments do not support autograd
+            self.agents_pos = torch.stack(agents_pos, dim=1)
+        else:
+            self.agents_pos = torch.stack(agents_pos, dim=1, out=self.agents_pos_buffer)
+
+    def agents_reward(self, agents_pos: Tensor):
+        (
+            self.distance_to_goal,
+            self.on_goal,
+            self.pos_shaping,
+            agents_pos_rew,
+        ) = self.agents_reward_fn(agents_pos, self.goals_pos, self.pos_shaping)
+
+        for i, a in enumerate(self.world.agents):
+            a.distance_to_goal = self.distance_to_goal[:, i]
+            a.on_goal = self.on_goal[:, i]
+            a.pos_rew = agents_pos_rew[:, i]
+        return agents_pos_rew
+
+    def compute_agents_reward(
+        self, agents_pos: Tensor, goals_pos: Tensor, pos_shaping: Tensor
+    ) -> Tuple[Tensor, Tensor, Tensor, Tensor]:
+        delta_pos = agents_pos - goals_pos
+        squared_distance_to_goal = (delta_pos * delta_pos).sum(-1)
+        on_goal = squared_distance_to_goal < self.goal_radius**2
+        distance_to_goal = squared_distance_to_goal.sqrt()
+
+        new_pos_shaping = distance_to_goal * self.pos_shaping_factor
+        return distance_to_goal, on_goal, new_pos_shaping, pos_shaping - new_pos_shaping
+
+    def compute_agents_collisions(self, agents_dist: Tensor) -> Tensor:
+        # Agents are spheres, so their distance is the one between centers minus the radii
+        return (
+            (agents_dist - 2 * self.agent_radius <= self.min_collision_distance)
+            & self.agents_collide_mask
+        ).sum(-1)
 
     def observation(self, agent: Agent):
-        goal_poses = []
+        if agent == self.world.agents[0]:
+            self.update_agents_pos()
+            self.agents_obs = self.agents_obs_fn(
+                self.agents_pos,
+                torch.stack([a.state.vel for a in self.world.agents], dim=1),
+                self.goals_pos,
+                (
+                    torch.stack(
+                        [a.sensors[0].measure() for a in self.world.agents], dim=1
+                    )
+                    if self.collisions
+                    else None
+                ),
+            )
+        return self.agents_obs[:, agent.agent_index]
+
+    def compute_agents_obs(
+        self,
+        agents_pos: Tensor,
+        agents_vel: Tensor,
+        goals_pos: Tensor,
+        lidar_measures: Optional[Tensor],
+    ) -> Tensor:
         if self.observe_all_goals:
-            for a in self.world.agents:
-                goal_poses.append(agent.state.pos - a.goal.state.pos)
+            goal_poses = (agents_pos.unsqueeze(2) - goals_pos.unsqueeze(1)).flatten(2)
         else:
-            goal_poses.append(agent.state.pos - agent.goal.state.pos)
-        return torch.cat(
+            goal_poses = agents_pos - goals_pos
+        obs = torch.cat(
             [
-                agent.state.pos,
-                agent.state.vel,
+                agents_pos,
+                agents_vel,
+                goal_poses,
             ]
-            + goal_poses
-            + (
-                [agent.sensors[0]._max_range - agent.sensors[0].measure()]
-                if self.collisions
-                else []
-            ),
+            + ([self.lidar_range - lidar_measures] if self.collisions else []),
             dim=-1,
         )
+        if self.obs_dtype is not None:
+            obs = obs.to(self.obs_dtype)
+        return obs
 
     def done(self):
-        return torch.stack(
-            [
-                torch.linalg.vector_norm(
-                    agent.state.pos - agent.goal.state.pos,
-                    dim=-1,
-                )
-                < agent.shape.radius
-                for agent in self.world.agents
-            ],
-            dim=-1,
+        self.update_agents_pos()
+        return (
+            torch.linalg.vector_norm(self.agents_pos - self.goals_pos, dim=-1)
+            < self.agent_radius
         ).all(-1)
 
+    def gather_rewards(self) -> Tensor:
+        # Last rewards of all agents in the envs of all distributed ranks, with shape (n_ranks * batch_dim, n_agents)
+        agents_rew = torch.stack(
+            [self.agent_total_reward(a) for a in self.world.agents], dim=-1
+        )
+        return TorchUtils.all_gather(agents_rew)
+
     def info(self, agent: Agent) -> Dict[str, Tensor]:
         return {
             "pos_rew": self.pos_rew if self.shared_rew else agent.pos_rew,
@@ -289,14 +413,15 @@ class Scenario(BaseScenario):
         geoms: List[Geom] = []
 
         # Communication lines
+        agents_pos = torch.stack([a.state.pos[env_index] for a in self.world.agents])
+        agents_in_range = (
+            torch.cdist(agents_pos, agents_pos) <= self.comms_range
+        ).tolist()
         for i, agent1 in enumerate(self.world.agents):
             for j, agent2 in enumerate(self.world.agents):
                 if j <= i:
                     continue
-                agent_dist = torch.linalg.vector_norm(
-                    agent1.state.pos - agent2.state.pos, dim=-1
-                )
-                if agent_dist[env_index] <= self.comms_range:
+                if agents_in_range[i][j]:
                     color = Color.BLACK.value
                     line = rendering.Line(
                         (agent1.state.pos[env_index]),
@@ -330,11 +455,12 @@ class HeuristicPolicy(BaseHeuristicPolicy):
         QP outputs:
         u: action
         CLF_slack: CLF constraint slack variable, 0 if CLF constraint is satisfied
-        """
-        # Install it with: pip install cvxpylayers
-        import cvxpy as cp
-        from cvxpylayers.torch import CvxpyLayer
 
+        The QP (min u^T @ u + clf_slack * CLF_slack**2, s.t. box bounds on u and
+        lfV + lgV @ u + clf_epsilon * V + CLF_slack <= 0) is solved in closed form:
+        u = clamp(-mu * lgV / 2, -u_range, u_range), where the CLF multiplier mu is found by
+        saturating the action components that hit their bounds.
+        """
         self.n_env = observation.shape[0]
         self.device = observation.device
         agent_pos = observation[:, :2]
@@ -366,46 +492,47 @@ class HeuristicPolicy(BaseHeuristicPolicy):
             ],
             dim=1,
         )
-        # Define Quadratic Program (QP) based controller
-        u = cp.Variable(2)
-        V_param = cp.Parameter(1)  # Lyapunov Function: V(x): x -> R, dim: (1,1)
-        lfV_param = cp.Parameter(1)
-        lgV_params = cp.Parameter(
-            2
-        )  # Lie derivative of Lyapunov Function, dim: (1, action_dim)
-        clf_slack = cp.Variable(1)  # CLF constraint slack variable, dim: (1,1)
-
-        constraints = []
-
-        # QP Cost F = u^T @ u + clf_slack**2
-        qp_objective = cp.Minimize(cp.sum_squares(u) + self.clf_slack * clf_slack**2)
-
-        # control bounds between u_range
-        constraints += [u <= u_range]
-        constraints += [u >= -u_range]
-        # CLF constraint
-        constraints += [
-            lfV_param + lgV_params @ u + self.clf_epsilon * V_param + clf_slack <= 0
-        ]
+        clf_value = LfV_val + self.clf_epsilon * V_value
 
-        QP_problem = cp.Problem(qp_objective, constraints)
+        return self.solve_clf_qp(clf_value, LgV_vals, u_range)
 
-        # Initialize CVXPY layers
-        QP_controller = CvxpyLayer(
-            QP_problem,
-            parameters=[V_param, lfV_param, lgV_params],
-            variables=[u],
-        )
+    def solve_clf_qp(self, clf_value: Tensor, LgV_vals: Tensor, u_range) -> Tensor:
+        """
+        Closed-form solution of min u^T @ u + clf_slack * max(0, clf_value + LgV @ u)**2
+        subject to -u_range <= u <= u_range.
 
-        # Solve QP
-        CVXpylayer_parameters = [
-            V_value.unsqueeze(1),
-            LfV_val.unsqueeze(1),
-            LgV_vals,
-        ]
-        action = QP_controller(*CVXpylayer_parameters, solver_args={"max_iters": 500})[
-            0
-        ]
+        Args:
+            clf_value: lfV + clf_epsilon * V, shape (n_envs,)
+            LgV_vals: Lie derivative of the Lyapunov function along the inputs, shape (n_envs, action_dim)
+            u_range: action bound, scalar or broadcastable to LgV_vals
+
+        Returns: the action u, shape (n_envs, action_dim)
+        """
+        if self.clf_slack == 0:
+            # The slack is not penalized, so the CLF constraint never needs any action
+            return torch.zeros_like(LgV_vals)
+
+        u_range = torch.as_tensor(
+            u_range, dtype=LgV_vals.dtype, device=LgV_vals.device
+        ).expand_as(LgV_vals)
+        LgV_abs = LgV_vals.abs()
+
+        # Without saturation, the active CLF constraint gives the multiplier in closed form.
+        # Each action component whose unsaturated value exceeds its bound is then fixed at the bound
+        # and the multiplier is recomputed, which converges in at most action_dim + 1 iterations.
+        saturated = torch.zeros_like(LgV_vals, dtype=torch.bool)
+        for _ in range(LgV_vals.shape[-1] + 1):
+            saturated_term = (saturated * u_range * LgV_abs).sum(-1)
+            free_term = (~saturated * LgV_vals**2 / 2).sum(-1)
+            clf_multiplier = torch.clamp(
+                (clf_value - saturated_term) / (free_term + 1 / (2 * self.clf_slack)),
+                min=0,
+            ).unsqueeze(-1)
+            saturated = saturated | (clf_multiplier * LgV_abs / 2 > u_range)
+
+        action = torch.maximum(
+            torch.minimum(-clf_multiplier * LgV_vals / 2, u_range), -u_range
+        )
 
         return action
 
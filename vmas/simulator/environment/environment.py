@@ -369,11 +369,17 @@ class Environment(TorchVectorizedObject):
 
     def get_agent_observation_space(self, agent: Agent, obs: AGENT_OBS_TYPE):
         if isinstance(obs, Tensor):
+            # Floating point observations keep their precision in the space,
+            # everything else is declared as float32
+            dtype = {
+                torch.float16: np.float16,
+                torch.float64: np.float64,
+            }.get(obs.dtype, np.float32)
             return spaces.Box(
-                low=-np.float32("inf"),
-                high=np.float32("inf"),
+                low=-dtype("inf"),
+                high=dtype("inf"),
                 shape=obs.shape[1:],
-                dtype=np.float32,
+                dtype=dtype,
             )
         elif isinstance(obs, Dict):
             return spaces.Dict(
@@ -6,7 +6,7 @@ import os
 import warnings
 from abc import ABC, abstractmethod
 from enum import Enum
-from typing import Dict, List, Sequence, Tuple, Union
+from typing import Callable, Dict, List, Sequence, Tuple, Union
 
 import numpy as np
 import torch
@@ -226,6 +226,80 @@ class TorchUtils:
         mask[env_index] = True
         return torch.where(mask, new_value, old_value)
 
+    @staticmethod
+    def all_gather(tensor: Tensor) -> Tensor:
+        # Concatenates a batched tensor along the batch dim across distributed ranks (e.g., launched with torchrun),
+        # where each rank simulates the same number of local envs
+        if (
+            not torch.distributed.is_available()
+            or not torch.distributed.is_initialized()
+        ):
+            return tensor
+        world_size = torch.distributed.get_world_size()
+        batch_size = torch.tensor([tensor.shape[0]], device=tensor.device)
+        batch_sizes = [torch.empty_like(batch_size) for _ in range(world_size)]
+        torch.distributed.all_gather(batch_sizes, batch_size)
+        batch_sizes = [size.item() for size in batch_sizes]
+        if any(size != batch_sizes[0] for size in batch_sizes):
+            raise ValueError(
+                f"all_gather requires the same batch size on every rank, got batch sizes {batch_sizes} across ranks"
+            )
+        tensors = [torch.empty_like(tensor) for _ in range(world_size)]
+        torch.distributed.all_gather(tensors, tensor.contiguous())
+        return torch.cat(tensors, dim=0)
+
+
+class CudaGraphFunction:
+    """Replays a tensor function with static input shapes from a recorded CUDA graph.
+
+    The first ``warmup_calls`` calls run ``fn`` eagerly (also triggering any ``torch.compile`` compilation).
+    The following call records ``fn`` in a :class:`torch.cuda.CUDAGraph` and all later calls copy their tensor
+    inputs into static buffers and replay it.
+
+    The returned tensors are static and are overwritten at every replay, so they have to be cloned
+    if they need to outlive the next call. Autograd is not supported: copying into the static buffers
+    would silently detach the inputs, so inputs that require grad raise an error.
+    """
+
+    def __init__(self, fn: Callable, warmup_calls: int = 3):
+        self.fn = fn
+        self.warmup_calls = warmup_calls
+        self._calls = 0
+        self._graph = None
+        self._static_inputs = None
+        self._static_outputs = None
+
+    def __call__(self, *inputs):
+        if any(isinstance(value, Tensor) and value.requires_grad for value in inputs):
+            raise RuntimeError(
+                "CudaGraphFunction does not support autograd, got an input that requires grad"
+            )
+        if self._graph is None:
+            if self._calls < self.warmup_calls:
+                self._calls += 1
+                return self.fn(*inputs)
+            self._record(inputs)
+        for static_input, value in zip(self._static_inputs, inputs):
+            if isinstance(static_input, Tensor):
+                static_input.copy_(value)
+        self._graph.replay()
+        return self._static_outputs
+
+    def _record(self, inputs):
+        self._static_inputs = [
+            value.clone() if isinstance(value, Tensor) else value for value in inputs
+        ]
+        # Warm up on a side stream before capturing, as required by CUDA graphs
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            self.fn(*self._static_inputs)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        self._graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self._graph):
+            self._static_outputs = self.fn(*self._static_inputs)
+
 
 class ScenarioUtils:
     @staticmethod
@@ -309,6 +383,66 @@ class ScenarioUtils:
                 )
         return pos
 
+    @staticmethod
+    def find_random_pos_for_entity_with_candidates(
+        occupied_positions: torch.Tensor,
+        env_index: int,
+        world,
+        min_dist_between_entities: float,
+        x_bounds: Tuple[int, int],
+        y_bounds: Tuple[int, int],
+        disable_warn: bool = False,
+        n_candidates: int = 16,
+    ):
+        # Like find_random_pos_for_entity, but draws n_candidates positions per env at once and keeps the first
+        # one that does not overlap. Only the envs where all candidates overlapped draw again.
+        batch_size = world.batch_dim if env_index is None else 1
+
+        def sample_candidates(n_envs: int):
+            low = torch.tensor([x_bounds[0], y_bounds[0]], device=world.device)
+            high = torch.tensor([x_bounds[1], y_bounds[1]], device=world.device)
+            candidates = torch.rand(
+                (n_envs, n_candidates, world.dim_p),
+                device=world.device,
+                dtype=torch.float32,
+            )
+            return low + candidates * (high - low)
+
+        def first_valid(candidates: Tensor, occupied: Tensor):
+            if occupied.shape[1] == 0:
+                valid = torch.ones(
+                    candidates.shape[:2], dtype=torch.bool, device=world.device
+                )
+            else:
+                valid = (
+                    torch.cdist(candidates, occupied) >= min_dist_between_entities
+                ).all(-1)
+            pos = candidates[
+                torch.arange(candidates.shape[0], device=world.device),
+                valid.int().argmax(-1),
+            ]
+            return pos, valid.any(-1)
+
+        pos, found = first_valid(sample_candidates(batch_size), occupied_positions)
+        missing = ~found
+        tries = 0
+        while missing.any():
+            missing_index = missing.nonzero().squeeze(-1)
+            new_pos, found = first_valid(
+                sample_candidates(len(missing_index)),
+                occupied_positions[missing_index],
+            )
+            pos[missing_index[found]] = new_pos[found]
+            missing[missing_index[found]] = False
+            tries += 1
+            if tries > 50_000 and not disable_warn:
+                warnings.warn(
+                    "It is taking many iterations to spawn the entity, make sure the bounds or "
+                    "the min_dist_between_entities are not too tight to fit all entities."
+                    "You can disable this warning by setting disable_warn=True"
+                )
+        return pos.unsqueeze(1)
+
     @staticmethod
     def check_kwargs_consumed(dictionary_of_kwargs: Dict, warn: bool = True):
         if len(dictionary_of_kwargs) > 0: